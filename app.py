@@ -1,17 +1,27 @@
+import hmac
 import logging
 import os
+import re
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import git
 from dotenv import load_dotenv
-from flask import Flask, jsonify, request
-from slack import WebClient
+from flask import Flask, request
+from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
+from slack_sdk.http_retry.builtin_handlers import RateLimitErrorRetryHandler
 from slackeventsapi import SlackEventAdapter
 
 DEPLOYS_CHANNEL_NAME = "#project-blt-lettuce-deploys"
 JOINS_CHANNEL_ID = "C06RMMRMGHE"
 CONTRIBUTE_ID = "C04DH8HEPTR"
+# "#contribute" already points at the channel, so it is matched only to rule the message out
+CONTRIBUTE_PATTERN = re.compile(r"#contribute|\bcontribut(?:e|es|ing)\b", re.IGNORECASE)
+MAX_DM_REPLIES_PER_USER = 3
+MAX_SEEN_EVENT_IDS = 1000
 
 load_dotenv()
 
@@ -24,23 +34,45 @@ logging.basicConfig(
 app = Flask(__name__)
 
 slack_events_adapter = SlackEventAdapter(os.environ["SIGNING_SECRET"], "/slack/events", app)
+# Optional: when set, /update_server only deploys for correctly signed GitHub webhooks
+GITHUB_WEBHOOK_SECRET = os.environ.get("GITHUB_WEBHOOK_SECRET")
+GITHUB_WEBHOOK_KEY = GITHUB_WEBHOOK_SECRET.encode("utf-8") if GITHUB_WEBHOOK_SECRET else None
+if GITHUB_WEBHOOK_KEY is None:
+    logging.warning(
+        "GITHUB_WEBHOOK_SECRET is not set: /update_server will accept unsigned requests"
+    )
 client = WebClient(token=os.environ["SLACK_TOKEN"])
-client.chat_postMessage(channel=DEPLOYS_CHANNEL_NAME, text="bot started v1.9 240611-1 top")
+# Back off on 429s (honouring Retry-After) during join bursts. A rate-limited call was never
+# applied, unlike a 5xx, which may come back after chat.postMessage already posted
+client.retry_handlers.append(RateLimitErrorRetryHandler(max_retry_count=2))
+# Background pools for Slack calls that don't need to block the event ack. They are opt-in:
+# hosts that don't run app threads (e.g. uWSGI without --enable-threads) would queue work that
+# never runs, so by default every task runs inline on the request thread
+BACKGROUND_TASKS = os.environ.get("BACKGROUND_TASKS", "false").lower() == "true"
+executor = ThreadPoolExecutor(max_workers=4)
+# Message replies get their own pool so a chatty user can't hold up welcomes or deploys
+message_executor = ThreadPoolExecutor(max_workers=4)
 
 
-@app.route("/slack/events", methods=["POST"])
-def slack_events():
-    data = request.json
+def run_in_background(fn, *args, pool=executor):
+    if not BACKGROUND_TASKS:
+        try:
+            fn(*args)
+        except Exception:
+            logging.exception(f"Error in task {fn.__name__}")
+        return
 
-    # Respond to Slack's URL verification challenge
-    if "challenge" in data:
-        return jsonify({"challenge": data["challenge"]})
+    # Exceptions raised in the pool would otherwise vanish with the future
+    def log_error(future):
+        if future.exception() is not None:
+            logging.error(
+                f"Error in background task {fn.__name__}", exc_info=future.exception()
+            )
 
-    # Handle other event types here
-    event = data.get("event", {})
-    handle_message(event)
+    pool.submit(fn, *args).add_done_callback(log_error)
 
-    return "Event received", 200
+
+client.chat_postMessage(channel=DEPLOYS_CHANNEL_NAME, text="bot started v1.9 240611-1 top")
 
 
 # keep for debugging purposes
@@ -55,32 +87,111 @@ def slack_events():
 # Determine the root directory (assumes the script is run from the root folder)
 root_dir = Path(__file__).resolve().parent
 
+# Read the welcome message once instead of on every team_join, split around its single
+# {user_id} placeholder so building it per join is a plain concatenation
+WELCOME_MESSAGE_PREFIX, WELCOME_MESSAGE_SUFFIX = (
+    (root_dir / "welcome_message.txt").read_text(encoding="utf-8").strip().split("{user_id}", 1)
+)
 
-@app.route("/update_server", methods=["POST"])
-def webhook():
-    if request.method == "POST":
-        current_directory = os.path.dirname(os.path.abspath(__file__))
-        repo = git.Repo(current_directory)
-        origin = repo.remotes.origin
-        origin.pull()
-        latest_commit_message = repo.head.commit.message.strip()
+
+def verify_github_signature(payload, signature):
+    if not signature or not signature.startswith("sha256="):
+        return False
+    # Headers arrive latin-1 decoded, so anything that isn't plain hex is simply a bad signature
+    try:
+        received = bytes.fromhex(signature[7:])
+    except ValueError:
+        return False
+    expected = hmac.digest(GITHUB_WEBHOOK_KEY, payload, "sha256")
+    return hmac.compare_digest(expected, received)
+
+
+# Concurrent pulls collide on .git/index.lock, so deploys run one at a time: on their own
+# single worker in the background, and under deploy_lock when run inline
+deploy_lock = threading.Lock()
+deploy_executor = ThreadPoolExecutor(max_workers=1)
+# At most one deploy waits behind the running one; further requests are merged into it.
+# Kept under its own lock so the webhook never blocks on a pull holding deploy_lock
+deploy_pending = False
+deploy_pending_lock = threading.Lock()
+
+
+def request_deploy():
+    global deploy_pending
+    with deploy_pending_lock:
+        if deploy_pending:
+            return False
+        deploy_pending = True
+    run_in_background(deploy, pool=deploy_executor)
+    return True
+
+
+def deploy():
+    global deploy_pending
+    with deploy_lock:
+        # Cleared once this pull starts, so a push landing mid-pull still gets its own deploy
+        with deploy_pending_lock:
+            deploy_pending = False
+        try:
+            repo = git.Repo(root_dir)
+            origin = repo.remotes.origin
+            origin.pull()
+            latest_commit_message = repo.head.commit.message.strip()
+        except git.GitCommandError as e:
+            # GitHub already got its 200, so make the failure visible where deploys are tracked
+            client.chat_postMessage(
+                channel=DEPLOYS_CHANNEL_NAME, text=f"Error deploying latest version: {e}"
+            )
+            raise
         client.chat_postMessage(
             channel=DEPLOYS_CHANNEL_NAME,
             text=f"Deployed the latest version 1.8. Latest commit: {latest_commit_message}",
         )
+
+
+@app.route("/update_server", methods=["POST"])
+def webhook():
+    # Reject forged requests before doing any git work
+    if GITHUB_WEBHOOK_KEY and not verify_github_signature(
+        request.get_data(), request.headers.get("X-Hub-Signature-256")
+    ):
+        return "Invalid signature", 403
+
+    if request.method == "POST":
+        # Pulling can outlast GitHub's webhook timeout, so acknowledge first and deploy after
+        if not request_deploy():
+            return "Deploy already pending", 200
         return "OK", 200
 
     return "Error", 400
 
 
-@slack_events_adapter.on("team_join")
-def handle_team_join(event_data):
-    user_id = event_data["event"]["user"]["id"]
+# Slack redelivers events it thinks we missed; remember recent event IDs so retries are no-ops
+seen_event_ids = OrderedDict()
+seen_event_ids_lock = threading.Lock()
+
 
+def is_duplicate_event(event_data):
+    event_id = event_data.get("event_id")
+    if event_id is None:
+        return False
+    with seen_event_ids_lock:
+        if event_id in seen_event_ids:
+            return True
+        seen_event_ids[event_id] = None
+        if len(seen_event_ids) > MAX_SEEN_EVENT_IDS:
+            seen_event_ids.popitem(last=False)
+    return False
+
+
+def notify_join(user_id):
     # Post a message in the private joins channel
-    response = client.chat_postMessage(
-        channel=JOINS_CHANNEL_ID, text=f"<@{user_id}> joined the team."
-    )
+    try:
+        response = client.chat_postMessage(
+            channel=JOINS_CHANNEL_ID, text=f"<@{user_id}> joined the team."
+        )
+    except SlackApiError as e:
+        response = e.response
 
     if not response["ok"]:
         client.chat_postMessage(
@@ -89,64 +200,125 @@ def handle_team_join(event_data):
         )
         logging.error(f"Error sending message: {response['error']}")
 
-    try:
-        response = client.conversations_open(users=[user_id])
-        dm_channel_id = response["channel"]["id"]
-
-        with open("welcome_message.txt", "r", encoding="utf-8") as file:
-            welcome_message_template = file.read()
 
-        welcome_message = welcome_message_template.format(user_id=user_id)
-        blocks = [{"type": "section", "text": {"type": "mrkdwn", "text": welcome_message.strip()}}]
+def send_welcome_message(user_id):
+    try:
+        welcome_message = WELCOME_MESSAGE_PREFIX + user_id + WELCOME_MESSAGE_SUFFIX
+        blocks = [{"type": "section", "text": {"type": "mrkdwn", "text": welcome_message}}]
 
+        # Posting to the user ID lands in the bot's DM with them, no conversations.open needed
         client.chat_postMessage(
-            channel=dm_channel_id, text="Welcome to the OWASP Slack Community!", blocks=blocks
+            channel=user_id, text="Welcome to the OWASP Slack Community!", blocks=blocks
         )
     except Exception as e:
         logging.error(f"Error sending welcome message: {e}")
 
 
-@slack_events_adapter.on("message")
-def handle_message(payload):
+@slack_events_adapter.on("team_join")
+def handle_team_join(event_data):
+    if is_duplicate_event(event_data):
+        return
+    user_id = event_data["event"]["user"]["id"]
+
+    # The joins channel notification and the welcome DM don't depend on each other,
+    # so run them side by side instead of paying for each Slack round trip in turn
+    run_in_background(notify_join, user_id)
+    run_in_background(send_welcome_message, user_id)
+
+
+# DM replies currently being sent, per user, so one user can't flood the bot
+dm_replies_in_flight = Counter()
+dm_replies_lock = threading.Lock()
+
+
+def acquire_dm_reply(user):
+    with dm_replies_lock:
+        if dm_replies_in_flight[user] >= MAX_DM_REPLIES_PER_USER:
+            return False
+        dm_replies_in_flight[user] += 1
+        return True
+
+
+def release_dm_reply(user):
+    with dm_replies_lock:
+        dm_replies_in_flight[user] -= 1
+        if dm_replies_in_flight[user] <= 0:
+            del dm_replies_in_flight[user]
+
+
+# The bot's own user ID doesn't change for the lifetime of the token
+bot_user_id = None
+
+
+def get_bot_user_id():
+    global bot_user_id
+    if bot_user_id is None:
+        try:
+            bot_user_id = client.auth_test()["user_id"]
+        except SlackApiError:
+            return None
+    return bot_user_id
+
+
+def mentions_contribute(text):
+    matches = [match.group() for match in CONTRIBUTE_PATTERN.finditer(text)]
+    return bool(matches) and not any(match.startswith("#") for match in matches)
+
+
+def process_message(payload):
     message = payload.get("event", {})
     try:
-        response = client.auth_test()
-        bot_user_id = response["user_id"]
-    except SlackApiError:
-        bot_user_id = None
-    # Check if the message was not sent by the bot itself
-    if message.get("user") != bot_user_id:
-        if (
-            message.get("subtype") is None
-            and not any(keyword in message.get("text", "").lower() for keyword in ["#contribute"])
-            and any(
-                keyword in message.get("text", "").lower()
-                for keyword in ("contribute", "contributing", "contributes")
-            )
-        ):
-            user = message.get("user")
-            channel = message.get("channel")
-            logging.info(f"detected contribute sending to channel: {channel}")
-            response = client.chat_postMessage(
-                channel=channel,
-                text=(
-                    f"Hello <@{user}>! Please check this channel "
-                    f"<#{CONTRIBUTE_ID}> for contributing guidelines today!"
-                ),
+        reply_to_message(message)
+    finally:
+        # The slot was claimed in handle_message before this task was queued
+        if message.get("channel_type") == "im":
+            release_dm_reply(message.get("user"))
+
+
+def reply_to_message(message):
+    # Only look up the bot's user ID once a message actually needs a reply, and
+    # check that it was not sent by the bot itself
+    if (
+        message.get("subtype") is None
+        and mentions_contribute(message.get("text", ""))
+        and message.get("user") != get_bot_user_id()
+    ):
+        user = message.get("user")
+        channel = message.get("channel")
+        logging.info(f"detected contribute sending to channel: {channel}")
+        response = client.chat_postMessage(
+            channel=channel,
+            text=(
+                f"Hello <@{user}>! Please check this channel "
+                f"<#{CONTRIBUTE_ID}> for contributing guidelines today!"
+            ),
+        )
+        if not response["ok"]:
+            client.chat_postMessage(
+                channel=DEPLOYS_CHANNEL_NAME,
+                text=f"Error sending message: {response['error']}",
             )
-            if not response["ok"]:
-                client.chat_postMessage(
-                    channel=DEPLOYS_CHANNEL_NAME,
-                    text=f"Error sending message: {response['error']}",
-                )
-                logging.error(f"Error sending message: {response['error']}")
+            logging.error(f"Error sending message: {response['error']}")
     if message.get("channel_type") == "im":
         user = message["user"]  # The user ID of the person who sent the message
         text = message.get("text", "")  # The text of the message
         try:
-            if message.get("user") != bot_user_id:
+            if user != get_bot_user_id():
                 client.chat_postMessage(channel=JOINS_CHANNEL_ID, text=f"<@{user}> said {text}")
             # Respond to the direct message
             client.chat_postMessage(channel=user, text=f"Hello <@{user}>, you said: {text}")
         except SlackApiError as e:
             print(f"Error sending response: {e.response['error']}")
+
+
+@slack_events_adapter.on("message")
+def handle_message(payload):
+    if is_duplicate_event(payload):
+        return
+    message = payload.get("event", {})
+    # Claim the DM slot before queueing so a flood is dropped here instead of filling the pool
+    if message.get("channel_type") == "im" and not acquire_dm_reply(message.get("user")):
+        logging.warning(f"Dropping DM from {message.get('user')}: too many replies in flight")
+        return
+    # Reply from the pool so the adapter can ack Slack without waiting on our API calls
+    run_in_background(process_message, payload, pool=message_executor)
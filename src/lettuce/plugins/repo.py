@@ -18,6 +18,30 @@ class RepoPlugin(MachineBasePlugin):
         with open(data_path) as f:
             self.repo_data = json.load(f)
 
+        # The technology picker only depends on repos.json, so build it once here
+        self.tech_select_blocks = [
+            {
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": "Here are the available technologies to choose from:",
+                },
+            },
+            {
+                "type": "actions",
+                "block_id": "tech_select_block",
+                "elements": [
+                    {
+                        "type": "button",
+                        "text": {"type": "plain_text", "text": tech},
+                        "value": tech,
+                        "action_id": f"plugin_repo_button_{tech}",
+                    }
+                    for tech in self.repo_data.keys()
+                ],
+            },
+        ]
+
     @command("/repo")
     async def repo(self, command):
         tech_name = command.text.strip().lower()
@@ -30,33 +54,8 @@ class RepoPlugin(MachineBasePlugin):
             await command.say(message)
         else:
             fallback_message = "Available technologies:"
-            message_preview = {
-                "blocks": [
-                    {
-                        "type": "section",
-                        "text": {
-                            "type": "mrkdwn",
-                            "text": "Here are the available technologies to choose from:",
-                        },
-                    },
-                    {
-                        "type": "actions",
-                        "block_id": "tech_select_block",
-                        "elements": [
-                            {
-                                "type": "button",
-                                "text": {"type": "plain_text", "text": tech},
-                                "value": tech,
-                                "action_id": f"plugin_repo_button_{tech}",
-                            }
-                            for tech in self.repo_data.keys()
-                        ],
-                    },
-                ]
-            }
-
             await self.web_client.chat_postMessage(
-                channel=channel_id, blocks=message_preview["blocks"], text=fallback_message
+                channel=channel_id, blocks=self.tech_select_blocks, text=fallback_message
             )
 
     @action(action_id=re.compile(r"plugin_repo_button_.*"), block_id=None)